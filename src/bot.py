@@ -1,10 +1,26 @@
+import asyncio
+import logging
 import sqlite3
 import time
 from enum import Enum
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, User
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode, ChatType
-from telegram.ext import ContextTypes, CommandHandler, filters, MessageHandler, CallbackQueryHandler
+from telegram.ext import ContextTypes, CommandHandler, filters, MessageHandler, CallbackQueryHandler, TypeHandler
+
+CASTER_FLUSH_INTERVAL = 30 # seconds between batched caster name saves
+
+logger = logging.getLogger(__name__)
+
+
+def chain_hook(existing, hook):
+    if existing is None:
+        return hook
+
+    async def chained(application):
+        await existing(application)
+        await hook(application)
+    return chained
 
 
 class UserConversationState(Enum):
@@ -16,10 +32,19 @@ class UserConversationState(Enum):
 class Bot:
     db: sqlite3.Connection
     cursor: sqlite3.Cursor
+    pending_casters: dict[int, str]
+    flush_task: asyncio.Task | None
 
     def __init__(self, db, application):
         self.db = db
         self.cursor = Bot.init_db(self.db)
+        self.pending_casters = {}
+        self.flush_task = None
+        application.post_init = chain_hook(application.post_init, self.post_init) # keep hooks set by the builder
+        application.post_stop = chain_hook(application.post_stop, self.post_stop)
+
+        caster_handler = TypeHandler(Update, self.remember_caster)
+        application.add_handler(caster_handler, -1) # runs before every other handler
 
         start_handler = CommandHandler('start', self.start)
         application.add_handler(start_handler)
@@ -36,14 +61,41 @@ class Bot:
         cursor = self.cursor.execute("SELECT 1 FROM admins WHERE id = ?;", [user_id])
         return len(cursor.fetchall()) > 0 # check if any rows found
 
-    def get_caster_name(self, caster: User):
-        cursor = self.cursor.execute("SELECT name FROM casters WHERE id=?;", [caster.id])
-        row = cursor.fetchone()
-        if row is None: # no existing name saved
-            self.cursor.execute("INSERT INTO casters(id, name) VALUES (?, ?);", [caster.id, caster.full_name])
+    async def remember_caster(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is not None:
+            self.pending_casters[user.id] = user.full_name # latest name wins, saved later by save_casters
+
+    def save_casters(self):
+        if not self.pending_casters:
+            return
+        # the buffer is unbounded: while saves keep failing it grows by one entry per distinct user
+        casters = list(self.pending_casters.items())
+        try:
+            self.cursor.executemany("""INSERT INTO casters(id, name) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET name = excluded.name;""", casters)
             self.db.commit()
-            return caster.full_name
-        return row[0]
+        except sqlite3.Error:
+            self.db.rollback() # keep the buffer, next save retries
+            raise
+        self.pending_casters.clear()
+
+    async def flush_casters(self):
+        while True:
+            await asyncio.sleep(CASTER_FLUSH_INTERVAL)
+            try:
+                self.save_casters()
+            except sqlite3.Error:
+                logger.exception("Failed to save caster names, retrying in %s seconds", CASTER_FLUSH_INTERVAL)
+
+    async def post_init(self, application):
+        self.flush_task = asyncio.create_task(self.flush_casters(), name="flush_casters")
+
+    async def post_stop(self, application):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.save_casters()
 
     @staticmethod
     def init_db(database: sqlite3.Connection):
@@ -52,7 +104,20 @@ class Bot:
         cursor.execute("CREATE TABLE IF NOT EXISTS polls(id INTEGER PRIMARY KEY, owner INTEGER, title TEXT);")
         cursor.execute("CREATE TABLE IF NOT EXISTS admins(id INTEGER PRIMARY KEY);")
         cursor.execute("CREATE TABLE IF NOT EXISTS casters(id INTEGER PRIMARY KEY, name TEXT);")
-        cursor.execute("CREATE TABLE IF NOT EXISTS votes(poll_id INTEGER, caster_id INTEGER, vote INTEGER, timestamp INTEGER, FOREIGN KEY(poll_id) REFERENCES polls(id), FOREIGN KEY(caster_id) REFERENCES casters(id));")
+        # votes don't reference casters: caster names are saved in batches, after the vote itself
+        cursor.execute("CREATE TABLE IF NOT EXISTS votes(poll_id INTEGER, caster_id INTEGER, vote INTEGER, timestamp INTEGER, FOREIGN KEY(poll_id) REFERENCES polls(id));")
+        cursor.execute("PRAGMA foreign_key_list(votes);")
+        if any(fk[2] == "casters" for fk in cursor.fetchall()): # migrate votes table from older schema
+            cursor.execute("BEGIN;") # sqlite3 doesn't open a transaction for DDL, so do it explicitly
+            try:
+                cursor.execute("ALTER TABLE votes RENAME TO votes_old;")
+                cursor.execute("CREATE TABLE votes(poll_id INTEGER, caster_id INTEGER, vote INTEGER, timestamp INTEGER, FOREIGN KEY(poll_id) REFERENCES polls(id));")
+                cursor.execute("INSERT INTO votes SELECT poll_id, caster_id, vote, timestamp FROM votes_old;")
+                cursor.execute("DROP TABLE votes_old;")
+                database.commit()
+            except sqlite3.Error:
+                database.rollback()
+                raise
         database.commit()
         return cursor
 
@@ -123,8 +188,13 @@ class Bot:
                 return
             msg = f'Результаты опроса "{poll[1]}" (#{poll_id}):\n'
 
-            cursor = self.cursor.execute("""SELECT casters.name FROM votes
-            JOIN casters ON casters.id = votes.caster_id
+            try:
+                self.save_casters() # show the latest names
+            except sqlite3.Error:
+                logger.exception("Failed to save caster names, showing results with stored names")
+
+            cursor = self.cursor.execute("""SELECT COALESCE(casters.name, votes.caster_id) FROM votes
+            LEFT JOIN casters ON casters.id = votes.caster_id
             WHERE votes.poll_id = ? AND votes.vote = 1
             ORDER BY votes.timestamp ASC;""", [poll_id])
             votes_1 = cursor.fetchall()
@@ -134,8 +204,8 @@ class Bot:
                 msg += f"{idx+1}: {caster}\n"
             msg += "</pre>"
 
-            cursor = self.cursor.execute("""SELECT casters.name FROM votes
-            JOIN casters ON casters.id = votes.caster_id
+            cursor = self.cursor.execute("""SELECT COALESCE(casters.name, votes.caster_id) FROM votes
+            LEFT JOIN casters ON casters.id = votes.caster_id
             WHERE votes.poll_id = ? AND votes.vote = 0
             ORDER BY votes.timestamp ASC;""", [poll_id])
             votes_0 = cursor.fetchall()
@@ -151,7 +221,6 @@ class Bot:
         timestamp = int(time.time())
         query = update.callback_query
         caster_id = update.effective_user.id
-        caster_name = self.get_caster_name(update.effective_user)
         try:
             poll_id, vote = map(int, query.data.split())
             if vote not in [0, 1]:
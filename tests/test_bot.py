@@ -1,8 +1,11 @@
+import asyncio
 import sqlite3
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 
+from telegram.ext import TypeHandler
+
 from src.bot import Bot, UserConversationState
 
 
@@ -278,6 +281,199 @@ async def test_vote_button_invalid_poll(bot, db):
     assert cur.fetchone() is None
 
 
+@pytest.mark.asyncio
+async def test_vote_button_does_not_touch_casters(bot, db):
+    update = AsyncMock()
+    update.effective_user.id = 456
+    update.effective_user.full_name = "John Doe"
+    query = AsyncMock()
+    query.data = "1 1"
+    update.callback_query = query
+    cur = db.cursor()
+    cur.execute("INSERT INTO polls(id, owner, title) VALUES(1, 123, 'Test Poll')")
+    db.commit()
+
+    await bot.vote_button(update, MagicMock())
+
+    cur.execute("SELECT 1 FROM casters WHERE id = 456")
+    assert cur.fetchone() is None
+    cur.execute("SELECT vote FROM votes WHERE poll_id = 1 AND caster_id = 456")
+    assert cur.fetchone()[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_remember_and_save_casters(bot, db):
+    cur = db.cursor()
+    cur.execute("INSERT INTO casters(id, name) VALUES(456, 'John Doe')")
+    db.commit()
+    update = AsyncMock()
+    update.effective_user.id = 456
+    update.effective_user.full_name = "John Smith"
+    await bot.remember_caster(update, MagicMock())
+    update.effective_user.id = 457
+    update.effective_user.full_name = "Maria Garcia"
+    await bot.remember_caster(update, MagicMock())
+    await bot.remember_caster(update, MagicMock())
+
+    assert bot.pending_casters == {456: "John Smith", 457: "Maria Garcia"}
+    bot.save_casters()
+
+    assert bot.pending_casters == {}
+    cur.execute("SELECT id, name FROM casters ORDER BY id")
+    assert cur.fetchall() == [(456, "John Smith"), (457, "Maria Garcia")]
+
+
+def test_init_db_migrates_votes_caster_foreign_key():
+    db_connection = sqlite3.connect(':memory:')
+    cur = db_connection.cursor()
+    cur.execute("CREATE TABLE polls(id INTEGER PRIMARY KEY, owner INTEGER, title TEXT);")
+    cur.execute("CREATE TABLE casters(id INTEGER PRIMARY KEY, name TEXT);")
+    cur.execute("CREATE TABLE votes(poll_id INTEGER, caster_id INTEGER, vote INTEGER, timestamp INTEGER, FOREIGN KEY(poll_id) REFERENCES polls(id), FOREIGN KEY(caster_id) REFERENCES casters(id));")
+    cur.execute("INSERT INTO polls(id, owner, title) VALUES(1, 123, 'Test Poll')")
+    cur.execute("INSERT INTO casters(id, name) VALUES(456, 'John Doe')")
+    cur.execute("INSERT INTO votes(poll_id, caster_id, vote, timestamp) VALUES(1, 456, 1, 12345)")
+    db_connection.commit()
+
+    cur = Bot.init_db(db_connection)
+
+    cur.execute("PRAGMA foreign_key_list(votes);")
+    assert [fk[2] for fk in cur.fetchall()] == ["polls"]
+    cur.execute("SELECT poll_id, caster_id, vote, timestamp FROM votes")
+    assert cur.fetchall() == [(1, 456, 1, 12345)]
+    db_connection.close()
+
+
+def test_init_db_migration_failure_keeps_old_votes():
+    db_connection = sqlite3.connect(':memory:')
+    cur = db_connection.cursor()
+    cur.execute("CREATE TABLE polls(id INTEGER PRIMARY KEY, owner INTEGER, title TEXT);")
+    cur.execute("CREATE TABLE casters(id INTEGER PRIMARY KEY, name TEXT);")
+    cur.execute("CREATE TABLE votes(poll_id INTEGER, caster_id INTEGER, vote INTEGER, timestamp INTEGER, FOREIGN KEY(poll_id) REFERENCES polls(id), FOREIGN KEY(caster_id) REFERENCES casters(id));")
+    cur.execute("CREATE TABLE votes_old(id INTEGER);") # makes the rename fail
+    cur.execute("INSERT INTO polls(id, owner, title) VALUES(1, 123, 'Test Poll')")
+    cur.execute("INSERT INTO casters(id, name) VALUES(456, 'John Doe')")
+    cur.execute("INSERT INTO votes(poll_id, caster_id, vote, timestamp) VALUES(1, 456, 1, 12345)")
+    db_connection.commit()
+
+    with pytest.raises(sqlite3.OperationalError):
+        Bot.init_db(db_connection)
+
+    assert not db_connection.in_transaction
+    cur = db_connection.cursor()
+    cur.execute("PRAGMA foreign_key_list(votes);")
+    assert "casters" in [fk[2] for fk in cur.fetchall()]
+    cur.execute("SELECT poll_id, caster_id, vote, timestamp FROM votes")
+    assert cur.fetchall() == [(1, 456, 1, 12345)]
+
+    # the next startup retries the migration
+    cur.execute("DROP TABLE votes_old;")
+    cur = Bot.init_db(db_connection)
+    cur.execute("PRAGMA foreign_key_list(votes);")
+    assert [fk[2] for fk in cur.fetchall()] == ["polls"]
+    cur.execute("SELECT poll_id, caster_id, vote, timestamp FROM votes")
+    assert cur.fetchall() == [(1, 456, 1, 12345)]
+    db_connection.close()
+
+
+def test_save_casters_failure_keeps_buffer(bot, db):
+    bot.pending_casters[456] = "John Doe"
+    db.execute("DROP TABLE casters;")
+
+    with pytest.raises(sqlite3.OperationalError):
+        bot.save_casters()
+
+    assert bot.pending_casters == {456: "John Doe"}
+
+
+def test_init_registers_lifecycle_and_caster_handler(db):
+    application = MagicMock()
+    application.post_init = None
+    application.post_stop = None
+
+    new_bot = Bot(db, application)
+
+    assert application.post_init == new_bot.post_init
+    assert application.post_stop == new_bot.post_stop
+    caster_calls = [call for call in application.add_handler.call_args_list
+                    if isinstance(call.args[0], TypeHandler)]
+    assert len(caster_calls) == 1
+    assert caster_calls[0].args[0].callback == new_bot.remember_caster
+    assert caster_calls[0].args[1] == -1
+
+
+@pytest.mark.asyncio
+async def test_init_keeps_existing_lifecycle_hooks(db):
+    application = MagicMock()
+    existing_post_init = AsyncMock()
+    existing_post_stop = AsyncMock()
+    application.post_init = existing_post_init
+    application.post_stop = existing_post_stop
+    new_bot = Bot(db, application)
+    new_bot.pending_casters[456] = "John Doe"
+
+    await application.post_init(application)
+    await application.post_stop(application)
+
+    existing_post_init.assert_awaited_once_with(application)
+    existing_post_stop.assert_awaited_once_with(application)
+    assert new_bot.flush_task is None # started by post_init, cancelled by post_stop
+    assert new_bot.pending_casters == {}
+
+
+@pytest.mark.asyncio
+async def test_post_init_starts_flush_task(bot):
+    await bot.post_init(MagicMock())
+
+    task = bot.flush_task
+    assert not task.done()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.asyncio
+async def test_post_stop_cancels_task_and_saves_casters(bot, db):
+    task = asyncio.create_task(asyncio.sleep(100))
+    bot.flush_task = task
+    bot.pending_casters[456] = "John Doe"
+
+    await bot.post_stop(MagicMock())
+    await asyncio.sleep(0)
+
+    assert task.cancelled()
+    assert bot.flush_task is None
+    assert bot.pending_casters == {}
+    cur = db.cursor()
+    cur.execute("SELECT name FROM casters WHERE id = 456")
+    assert cur.fetchone()[0] == "John Doe"
+
+
+@pytest.mark.asyncio
+async def test_flush_casters_saves_periodically_and_survives_errors(bot, db, mocker):
+    mocker.patch("src.bot.CASTER_FLUSH_INTERVAL", 0)
+    save_casters = bot.save_casters
+    calls = []
+
+    def failing_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        save_casters()
+        task.cancel() # stops the loop at its next sleep
+
+    mocker.patch.object(bot, "save_casters", side_effect=failing_once)
+    bot.pending_casters[456] = "John Doe"
+    task = asyncio.create_task(bot.flush_casters())
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, 1)
+
+    assert len(calls) == 2
+    assert bot.pending_casters == {}
+    cur = db.cursor()
+    cur.execute("SELECT name FROM casters WHERE id = 456")
+    assert cur.fetchone()[0] == "John Doe"
+
+
 @pytest.mark.asyncio
 async def test_start_results(bot):
     update = AsyncMock()
@@ -438,3 +634,57 @@ async def test_get_results_as_non_admin(bot, db):
     assert "James Smith" not in sent_text
     assert "Robert Williams" not in sent_text
     assert "Maria Garcia" not in sent_text
+
+
+@pytest.mark.asyncio
+async def test_get_results_shows_latest_caster_names(bot, db):
+    update = AsyncMock()
+    update.effective_user.id = 1
+    update.effective_user.full_name = "Admin"
+    update.message.text = "1"
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+    context.user_data = {"state": UserConversationState.SETTING_POLL_ID_FOR_RESULT}
+    cur = db.cursor()
+    cur.execute("INSERT INTO polls(id, owner, title) VALUES(1, 1, 'Test Poll')")
+    cur.execute("INSERT INTO admins(id) VALUES(1)")
+    cur.execute("INSERT INTO casters(id, name) VALUES(456, 'John Doe')")
+    cur.execute("""INSERT INTO votes(poll_id, caster_id, vote, timestamp) VALUES
+                    (1, 456, 1, 12345),
+                    (1, 457, 0, 12346);""")
+    db.commit()
+    bot.pending_casters[456] = "John Smith"
+    bot.pending_casters[457] = "Maria Garcia"
+
+    await bot.message(update, context)
+
+    sent_text = context.bot.send_message.call_args[0][1]
+    assert "John Smith" in sent_text
+    assert "John Doe" not in sent_text
+    assert "Maria Garcia" in sent_text
+
+
+@pytest.mark.asyncio
+async def test_get_results_when_saving_casters_fails(bot, db, mocker):
+    update = AsyncMock()
+    update.effective_user.id = 1
+    update.message.text = "1"
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+    context.user_data = {"state": UserConversationState.SETTING_POLL_ID_FOR_RESULT}
+    cur = db.cursor()
+    cur.execute("INSERT INTO polls(id, owner, title) VALUES(1, 1, 'Test Poll')")
+    cur.execute("INSERT INTO admins(id) VALUES(1)")
+    cur.execute("INSERT INTO casters(id, name) VALUES(456, 'John Doe')")
+    cur.execute("INSERT INTO votes(poll_id, caster_id, vote, timestamp) VALUES(1, 456, 1, 12345)")
+    db.commit()
+    mocker.patch.object(bot, "save_casters", side_effect=sqlite3.OperationalError("database is locked"))
+    bot.pending_casters[456] = "John Smith"
+
+    await bot.message(update, context)
+
+    context.bot.send_message.assert_called_once()
+    sent_text = context.bot.send_message.call_args[0][1]
+    assert "John Doe" in sent_text
+    assert context.user_data["state"] == UserConversationState.NONE
+    assert bot.pending_casters == {456: "John Smith"}